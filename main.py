@@ -1,9 +1,24 @@
-import os
-import math
+import asyncio
 import logging
-from fastapi import FastAPI, HTTPException
+import os
+import socket
+import time
+from contextlib import asynccontextmanager, suppress
+
+import coincurve
+import httpx
+import msgpack
+import msgspec
+import orjson
+import websockets
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse
 from eth_account import Account
-from hyperliquid.exchange import Exchange
+from eth_utils import keccak
+from hyperliquid.utils.signing import (
+    order_request_to_order_wire,
+    order_wires_to_order_action,
+)
 
 logging.basicConfig(level=logging.ERROR)
 
@@ -16,103 +31,549 @@ PRIVATE_KEY = os.getenv("HYPERLIQUID_PRIVATE_KEY")
 DEFAULT_LEVERAGE = float(os.getenv("DEFAULT_LEVERAGE", "3"))
 MAX_RISK_PCT = float(os.getenv("MAX_RISK_PCT", "2"))  # percent
 
+API_URL = "https://api.hyperliquid.xyz"
+WS_URL = "wss://api.hyperliquid.xyz/ws"
+SLIPPAGE = 0.05  # max slippage tolerated on IoC market orders
+
+# fall back to REST when the WS feed has been silent this long
+WS_STALE = 2.0
+
+# how long the cached meta()/szDecimals universe stays valid; 0 = forever
+META_TTL = float(os.getenv("META_TTL", "3600"))
+
+# mids barely move within a burst of identical alerts; 0 = always refetch
+PRICE_CACHE_TTL = float(os.getenv("PRICE_CACHE_TTL", "0.25"))
+
+# user_state shared across a burst the same way; invalidated after
+# every order placement
+STATE_CACHE_TTL = float(os.getenv("STATE_CACHE_TTL", "0.5"))
+
+# window in which a repeated (coin, side, bar_time) alert is dropped
+DEDUP_TTL = float(os.getenv("DEDUP_TTL", "60"))
+
+# acknowledge TradingView right after validation and place the order in
+# the background, so a slow exchange response can't trigger TV's
+# timeout-retry storm; set to 0 to wait for the fill before responding
+ACK_FIRST = os.getenv("ACK_FIRST", "1") == "1"
+
+# outbound request budget; stay under Hyperliquid's limit instead of
+# paying for 429s after the fact
+RATE_LIMIT_RPS = float(os.getenv("RATE_LIMIT_RPS", "10"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "20"))
+
 if not WALLET or not PRIVATE_KEY:
     raise RuntimeError("Missing HYPERLIQUID_WALLET or HYPERLIQUID_PRIVATE_KEY")
 
 # ================================
-# HYPERLIQUID CLIENT
+# SIGNING
 # ================================
 acct = Account.from_key(PRIVATE_KEY)
 
 if acct.address.lower() != WALLET.lower():
     raise RuntimeError("PRIVATE KEY does not match API wallet address")
 
-exchange = Exchange(acct)
+# libsecp256k1 signer; ~50x faster than eth-keys' pure-Python ECDSA
+SIGNER = coincurve.PrivateKey(bytes.fromhex(PRIVATE_KEY.removeprefix("0x")))
+
+# The EIP-712 pieces of an L1 action signature are constant for the
+# chain, so hash them once at import instead of per order. Only the
+# msgpack of the action itself varies per request.
+DOMAIN_SEPARATOR = keccak(
+    keccak(b"EIP712Domain(string name,string version,uint256 chainId,address verifyingContract)")
+    + keccak(b"Exchange")
+    + keccak(b"1")
+    + (1337).to_bytes(32, "big")
+    + bytes(32)
+)
+AGENT_TYPEHASH = keccak(b"Agent(string source,bytes32 connectionId)")
+AGENT_SOURCE_HASH = keccak(b"a")  # "a" selects mainnet
+
+def action_digest(action, nonce):
+    data = msgpack.packb(action)
+    data += nonce.to_bytes(8, "big")
+    data += b"\x00"  # no vault address
+    connection_id = keccak(data)
+    struct_hash = keccak(AGENT_TYPEHASH + AGENT_SOURCE_HASH + connection_id)
+    return keccak(b"\x19\x01" + DOMAIN_SEPARATOR + struct_hash)
+
+def sign_action(action, nonce):
+    sig = SIGNER.sign_recoverable(action_digest(action, nonce), hasher=None)
+    return {
+        "r": hex(int.from_bytes(sig[:32], "big")),
+        "s": hex(int.from_bytes(sig[32:64], "big")),
+        "v": sig[64] + 27,
+    }
+
+# ================================
+# HYPERLIQUID CLIENT
+# ================================
+# One pooled async client for every Hyperliquid call, created in the
+# lifespan below so it lives on the event loop.
+http: httpx.AsyncClient = None
+
+# meta()/szDecimals is static per asset; loaded once at startup
+META = None
+META_AT = 0.0
+SZ_DECIMALS = {}
+SZ_FACTOR = {}
+ASSET_IDX = {}
+SIZE_FN = {}
+
+def _size_fn(q):
+    # Specialized per coin at meta load: risk sizing truncated to the
+    # coin's szDecimals with no dict or round() lookups on the hot path.
+    # Returns the size in integer szDecimals steps; callers divide by
+    # SZ_FACTOR only at the wire boundary. The relative epsilon nudges
+    # values sitting a few ulps below an integer (e.g. 123.99999999
+    # from the FP divide) onto it before truncating — at any magnitude,
+    # since FP error scales with the value — so a representational
+    # artifact can't shave a size step or reject a boundary-sized
+    # trade.
+    def f(balance, risk_frac, leverage, px):
+        return int(balance * risk_frac * leverage / px * q * (1 + 1e-9))
+    return f
+META_LOCK = asyncio.Lock()
+
+# Nonces must reach the exchange in order per account; serialize the
+# sign+submit sequence while leaving reads free to overlap. One wallet
+# per process, so one lock.
+ACCT_LOCK = asyncio.Lock()
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, cost=1.0):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.at) * self.rate)
+                self.at = now
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    return
+                await asyncio.sleep((cost - self.tokens) / self.rate)
+
+BUCKET = TokenBucket(RATE_LIMIT_RPS, RATE_LIMIT_BURST)
+
+async def post_info(payload):
+    await BUCKET.acquire()
+    r = await http.post("/info", content=orjson.dumps(payload))
+    r.raise_for_status()
+    return orjson.loads(r.content)
+
+async def post_action(action):
+    await BUCKET.acquire()
+    nonce = int(time.time() * 1000)
+    sig = sign_action(action, nonce)
+    r = await http.post("/exchange", content=orjson.dumps({
+        "action": action,
+        "nonce": nonce,
+        "signature": sig,
+        "vaultAddress": None,
+    }))
+    r.raise_for_status()
+    return orjson.loads(r.content)
+
+# Caches fed by the WS task below; REST is the fallback when stale
+MIDS = None
+MIDS_AT = 0.0
+MIDS_LOCK = asyncio.Lock()
+STATE = None
+STATE_AT = 0.0
+STATE_LOCK = asyncio.Lock()
+WS_UP = False
+
+def _state_fresh():
+    fresh = WS_STALE if WS_UP else STATE_CACHE_TTL
+    return STATE is not None and time.monotonic() - STATE_AT < fresh
+
+async def user_state():
+    global STATE, STATE_AT
+    if _state_fresh():
+        return STATE
+    # Single-flight: a burst of concurrent webhooks shares one fetch
+    async with STATE_LOCK:
+        if not _state_fresh():
+            STATE = await post_info({"type": "clearinghouseState", "user": acct.address})
+            STATE_AT = time.monotonic()
+    return STATE
+
+def invalidate_state():
+    # Positions/balance just changed; don't serve the pre-trade snapshot
+    global STATE_AT
+    STATE_AT = 0.0
+
+def _mids_fresh():
+    fresh = WS_STALE if WS_UP else PRICE_CACHE_TTL
+    return MIDS is not None and time.monotonic() - MIDS_AT < fresh
+
+async def all_mids():
+    global MIDS, MIDS_AT
+    if _mids_fresh():
+        return MIDS
+    # Burst of concurrent misses shares one fetch instead of stampeding
+    async with MIDS_LOCK:
+        if not _mids_fresh():
+            MIDS = await post_info({"type": "allMids"})
+            MIDS_AT = time.monotonic()
+    return MIDS
+
+async def ws_loop():
+    # Long-lived subscription keeping mids and user state hot in memory,
+    # so most webhooks read them with zero outbound I/O.
+    global MIDS, MIDS_AT, STATE, STATE_AT, WS_UP
+    while True:
+        try:
+            async with websockets.connect(WS_URL, ping_interval=20) as ws:
+                await ws.send(orjson.dumps({
+                    "method": "subscribe",
+                    "subscription": {"type": "allMids"},
+                }).decode())
+                await ws.send(orjson.dumps({
+                    "method": "subscribe",
+                    "subscription": {"type": "webData2", "user": acct.address},
+                }).decode())
+                WS_UP = True
+                async for raw in ws:
+                    msg = orjson.loads(raw)
+                    channel = msg.get("channel")
+                    if channel == "allMids":
+                        MIDS = msg["data"]["mids"]
+                        MIDS_AT = time.monotonic()
+                    elif channel == "webData2":
+                        STATE = msg["data"]["clearinghouseState"]
+                        STATE_AT = time.monotonic()
+        except Exception as e:
+            logging.error("ws: %s", e)
+        WS_UP = False
+        await asyncio.sleep(1)
+
+async def load_meta():
+    global META, META_AT, SZ_DECIMALS, SZ_FACTOR, ASSET_IDX, SIZE_FN
+    META = await post_info({"type": "meta"})
+    SZ_DECIMALS = {a["name"]: int(a.get("szDecimals", 0)) for a in META["universe"]}
+    SZ_FACTOR = {name: 10 ** d for name, d in SZ_DECIMALS.items()}
+    ASSET_IDX = {a["name"]: i for i, a in enumerate(META["universe"])}
+    SIZE_FN = {name: _size_fn(q) for name, q in SZ_FACTOR.items()}
+    META_AT = time.monotonic()
+
+def _meta_stale():
+    if META is None:
+        return True
+    return META_TTL > 0 and time.monotonic() - META_AT > META_TTL
+
+async def meta_cached():
+    # Only the first caller (or the first after TTL expiry, to pick up
+    # rare universe additions without a restart) pays the fetch.
+    if _meta_stale():
+        async with META_LOCK:
+            if _meta_stale():
+                await load_meta()
+    return META
+
+async def update_leverage(coin, leverage):
+    return await post_action({
+        "type": "updateLeverage",
+        "asset": ASSET_IDX[coin],
+        "isCross": True,
+        "leverage": int(leverage),
+    })
+
+def slippage_px(coin, is_buy, mid):
+    px = mid * (1 + SLIPPAGE) if is_buy else mid * (1 - SLIPPAGE)
+    # Hyperliquid wants at most 5 significant figures and
+    # (6 - szDecimals) decimals on perp prices
+    px = float(f"{px:.5g}")
+    return round(px, 6 - SZ_DECIMALS.get(coin, 0))
+
+def market_wire(coin, is_buy, sz, mid, reduce_only=False):
+    return order_request_to_order_wire({
+        "coin": coin,
+        "is_buy": is_buy,
+        "sz": sz,
+        "limit_px": slippage_px(coin, is_buy, mid),
+        "order_type": {"limit": {"tif": "Ioc"}},
+        "reduce_only": reduce_only,
+    }, ASSET_IDX[coin])
 
-app = FastAPI()
+async def send_orders(wires):
+    # One signed action regardless of leg count, so a reversal
+    # (reduce-only close + new open) costs a single signature and RTT
+    return await post_action(order_wires_to_order_action(wires))
+
+# ================================
+# APP
+# ================================
+@asynccontextmanager
+async def lifespan(app):
+    global http
+    http = httpx.AsyncClient(
+        base_url=API_URL,
+        trust_env=False,
+        timeout=httpx.Timeout(10.0, connect=2.0),
+        # With an explicit transport, pool settings must live on the
+        # transport — client-level http2/limits would be silently
+        # ignored
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=1,
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=40,
+                keepalive_expiry=30,
+            ),
+            # no Nagle delay on small signed payloads; keep the pooled
+            # connections from idling out at the OS level
+            socket_options=[
+                (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+            ],
+        ),
+        headers={"Content-Type": "application/json"},
+    )
+    # Warm-up: pay TCP+TLS establishment now, not on the first webhook.
+    # The meta load doubles as the warm-up request.
+    await load_meta()
+    ws_task = asyncio.create_task(ws_loop())
+    yield
+    ws_task.cancel()
+    with suppress(asyncio.CancelledError):
+        await ws_task
+    await http.aclose()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # ================================
 # HELPERS
 # ================================
-def get_state():
-    return exchange.info.user_state(acct.address)
+# gc=False: signals hold no cycles, so skip GC tracking on each decode
+class Signal(msgspec.Struct, gc=False):
+    action: str
+    coin: str = "BTC"
+    leverage: float = DEFAULT_LEVERAGE
+    risk_pct: float = MAX_RISK_PCT
+    return_fill: bool = False
+    bar_time: str | None = None
+
+    def __post_init__(self):
+        self.action = self.action.strip().upper()
+        self.coin = self.coin.strip().upper()
+        if self.action not in ("BUY", "SELL"):
+            raise ValueError("action must be BUY or SELL")
+        if self.leverage <= 0:
+            raise ValueError("leverage must be positive")
+        if self.risk_pct <= 0:
+            raise ValueError("risk_pct must be positive")
+        self.risk_pct = min(self.risk_pct, MAX_RISK_PCT)
+
+# strict=False coerces string-typed numbers ("5" -> 5.0), which some
+# TradingView alert templates emit
+SIGNAL_DECODER = msgspec.json.Decoder(Signal, strict=False)
+BATCH_DECODER = msgspec.json.Decoder(list[Signal], strict=False)
+
+async def parse_signal(request: Request) -> Signal:
+    try:
+        return SIGNAL_DECODER.decode(await request.body())
+    except (msgspec.DecodeError, ValueError) as e:
+        raise HTTPException(400, str(e))
+
+async def parse_signals(request: Request) -> list[Signal]:
+    try:
+        return BATCH_DECODER.decode(await request.body())
+    except (msgspec.DecodeError, ValueError) as e:
+        raise HTTPException(400, str(e))
 
-def get_balance():
-    return float(get_state()["crossMarginSummary"]["accountValue"])
+def get_balance(state):
+    return float(state["crossMarginSummary"]["accountValue"])
 
-def get_position():
-    for p in get_state()["assetPositions"]:
-        pos = p["position"]
-        if pos["coin"] == "BTC":
-            return float(pos["szi"]), float(pos.get("entryPx", 0))
-    return 0.0, 0.0
+def positions_by_coin(state):
+    return {p["position"]["coin"]: p["position"] for p in state.get("assetPositions", [])}
 
-def get_price():
-    return float(exchange.info.all_mids()["BTC"])
+def get_position(state, coin):
+    pos = positions_by_coin(state).get(coin)
+    if pos is None:
+        return 0.0, 0.0
+    return float(pos["szi"]), float(pos.get("entryPx", 0))
 
-def get_decimals():
-    meta = exchange.info.meta()
-    for m in meta["universe"]:
-        if m["name"] == "BTC":
-            return int(m["szDecimals"])
-    return 3
+# leverage we last applied per coin; updateLeverage is a signed RTT
+# that is a no-op when the value already matches
+LEV_APPLIED = {}
 
-def round_down(v, d):
-    f = 10 ** d
-    return math.floor(v * f) / f
+# Burst control: signals for one coin run serially, and a signal that
+# was overtaken by a newer one for the same coin while waiting is
+# dropped instead of firing a stale order at the exchange.
+COIN_LOCKS = {}
+COIN_GEN = {}
+
+def coin_lock(coin):
+    lock = COIN_LOCKS.get(coin)
+    if lock is None:
+        lock = COIN_LOCKS[coin] = asyncio.Lock()
+    return lock
+
+# last executed (bar_time, at) per (coin, side); TradingView retries on
+# 5xx, so the same bar often arrives more than once
+LAST_SIGNAL = {}
+
+def is_duplicate(coin, side, bar_time):
+    if bar_time is None:
+        return False
+    seen = LAST_SIGNAL.get((coin, side))
+    return (
+        seen is not None
+        and seen[0] == bar_time
+        and time.monotonic() - seen[1] < DEDUP_TTL
+    )
+
+def mark_executed(coin, side, bar_time):
+    if bar_time is not None:
+        LAST_SIGNAL[(coin, side)] = (bar_time, time.monotonic())
 
 # ================================
 # API
 # ================================
 @app.get("/")
-def root():
+async def root():
     return {"ok": True}
 
 @app.post("/webhook")
-def trade(signal: dict):
+async def trade(bg: BackgroundTasks, signal: Signal = Depends(parse_signal)):
     try:
-        side = signal.get("action", "").upper()
-        if side not in ["BUY", "SELL"]:
-            raise HTTPException(400, "action must be BUY or SELL")
+        side = signal.action  # validated and uppercased at parse time
+        coin = signal.coin
+        leverage = signal.leverage
+        risk_pct = signal.risk_pct  # clamped to MAX_RISK_PCT at parse time
 
-        leverage = float(signal.get("leverage", DEFAULT_LEVERAGE))
-        risk_pct = min(float(signal.get("risk_pct", MAX_RISK_PCT)), MAX_RISK_PCT)
+        # Retried alerts for the same bar cost zero RPCs
+        if is_duplicate(coin, side, signal.bar_time):
+            return {"status": "duplicate"}
 
-        balance = get_balance()
-        price = get_price()
-        pos, entry = get_position()
-        decimals = get_decimals()
+        gen = COIN_GEN.get(coin, 0) + 1
+        COIN_GEN[coin] = gen
 
-        risk_usd = balance * (risk_pct / 100)
-        notional = risk_usd * leverage
-        size = round_down(notional / price, decimals)
+        # Callers that want the fill in the response wait for it;
+        # everyone else gets an immediate ack
+        if ACK_FIRST and not signal.return_fill:
+            bg.add_task(execute_signal_logged, signal, side, coin, leverage, risk_pct, gen)
+            return {"status": "queued", "side": side, "coin": coin}
 
-        if size <= 0:
-            raise HTTPException(400, "Trade size too small")
+        return await execute_signal(signal, side, coin, leverage, risk_pct, gen)
 
-        # Close opposite
-        if pos > 0 and side == "SELL":
-            exchange.market_close("BTC")
-        if pos < 0 and side == "BUY":
-            exchange.market_close("BTC")
+    except HTTPException:
+        # caller error (bad coin, size too small, ...) — surface the 4xx
+        raise
+    except httpx.TransportError as e:
+        # connection-level failure; the pooled client recovers by
+        # itself, and a 502 lets TradingView retry the alert
+        logging.error("transport: %s", e)
+        raise HTTPException(502, "exchange unreachable")
+    except Exception as e:
+        logging.error(str(e))
+        return {"status": "error"}
 
-        exchange.update_leverage(leverage, "BTC", is_cross=True)
+@app.post("/webhook/batch")
+async def trade_batch(signals: list[Signal] = Depends(parse_signals)):
+    # Fan out all signals at once: the single-flight state/mids caches
+    # mean the whole batch shares one snapshot fetch, per-coin locks
+    # keep same-coin orders serialized, and different coins overlap.
+    async def run(signal):
+        side, coin = signal.action, signal.coin
+        if is_duplicate(coin, side, signal.bar_time):
+            return {"status": "duplicate", "coin": coin}
+        gen = COIN_GEN.get(coin, 0) + 1
+        COIN_GEN[coin] = gen
+        return await execute_signal(signal, side, coin, signal.leverage, signal.risk_pct, gen)
+
+    results = await asyncio.gather(*(run(s) for s in signals), return_exceptions=True)
+    out = []
+    for signal, res in zip(signals, results):
+        if isinstance(res, HTTPException):
+            out.append({"status": "error", "coin": signal.coin, "detail": res.detail})
+        elif isinstance(res, Exception):
+            logging.error(str(res))
+            out.append({"status": "error", "coin": signal.coin})
+        else:
+            out.append(res)
+    return out
+
+async def execute_signal_logged(signal, side, coin, leverage, risk_pct, gen):
+    try:
+        await execute_signal(signal, side, coin, leverage, risk_pct, gen)
+    except Exception as e:
+        logging.error(str(e))
+
+async def execute_signal(signal, side, coin, leverage, risk_pct, gen):
+    async with coin_lock(coin):
+        # A newer signal for this coin arrived while we queued; firing
+        # this one now would place a stale order and waste rate limit
+        if COIN_GEN.get(coin) != gen:
+            return {"status": "superseded"}
+
+        # Re-check dedup under the lock: a retry of the same bar that
+        # arrived while the first copy was still in flight passed the
+        # handler's check (mark_executed only runs post-order) and
+        # would double the position here
+        if is_duplicate(coin, side, signal.bar_time):
+            return {"status": "duplicate"}
+
+        # One state fetch covers balance and position; accountValue only
+        # moves by the close PnL, which is noise next to risk sizing.
+        # The three reads are independent, so overlap them.
+        state, mids, _ = await asyncio.gather(user_state(), all_mids(), meta_cached())
+
+        if coin not in ASSET_IDX:
+            raise HTTPException(400, f"unknown coin {coin}")
+
+        balance = get_balance(state)
+        price = float(mids[coin])
+        pos, entry = get_position(state, coin)
+
+        size_steps = SIZE_FN[coin](balance, risk_pct / 100, leverage, price)
+
+        if size_steps <= 0:
+            raise HTTPException(400, "Trade size too small")
+
+        size = size_steps / SZ_FACTOR[coin]
 
         is_buy = side == "BUY"
-        exchange.market_open("BTC", is_buy, size)
 
-        # Fetch updated state
-        new_pos, new_entry = get_position()
-        new_balance = get_balance()
+        # A single order larger than the opposite position flattens and
+        # flips atomically under net-position semantics, so a reversal
+        # needs no separate reduce-only close leg.
+        flip = (pos > 0 and side == "SELL") or (pos < 0 and side == "BUY")
+        order_sz = abs(pos) + size if flip else size
+        wire = market_wire(coin, is_buy, order_sz, price)
+
+        async with ACCT_LOCK:
+            if LEV_APPLIED.get(coin) != leverage:
+                await update_leverage(coin, leverage)
+                LEV_APPLIED[coin] = leverage
+            await send_orders([wire])
+        invalidate_state()
+        mark_executed(coin, side, signal.bar_time)
+
+        if not signal.return_fill:
+            return {
+                "status": "success",
+                "side": side,
+                "size": size,
+                "price": price,
+                "account_value": balance
+            }
+
+        # Optional second fetch for callers that want the actual fill
+        final_state = await user_state()
+        new_pos, new_entry = get_position(final_state, coin)
 
         return {
             "status": "success",
             "side": side,
             "size": abs(new_pos),
             "price": new_entry,
-            "account_value": new_balance
+            "account_value": get_balance(final_state)
         }
-
-    except Exception as e:
-        logging.error(str(e))
-        return {"status": "error"}